@@ -1,5 +1,12 @@
+import io
+import bz2
+import gzip
 import itertools
 import mock
+import os
+import shutil
+import tempfile
+import threading
 import time
 import textcatcher as catcher
 import unittest
@@ -35,11 +42,28 @@ class CatcherAPI(object):
     def done(self): pass
     def line(self, txt):
         self.lines = [txt]
+    def reset(self):
+        self.lines = []
     def add_callback(self, *args): pass
     def rm_callback(self, *args): pass
     def clear_callbacks(self): pass
     # data API not included, FIXME
 
+class Shout(catcher.TextCatcher):
+    """ module level so it can be sent to worker processes """
+    def parse(self):
+        return self.lines[-1].upper()
+
+class Finishing(catcher.TextCatcher):
+    """ counts done() calls and raises on 'fail', for worker processes """
+    dones = 0
+    def parse(self):
+        if 'fail' in self.lines[-1]:
+            raise ValueError(self.lines[-1])
+    def done(self):
+        self.dones += 1
+        catcher.TextCatcher.done(self)
+
 class TestCatchQ(unittest.TestCase):
     def setUp(self):
         self.catchq = catcher.CatchQueue()
@@ -204,6 +228,252 @@ class TestCatchQ(unittest.TestCase):
         ob.reset = make_raise_x(ResetCalled())
         self.assertRaises(ResetCalled, self.catchq.line, '')
 
+    def test_prefilter(self):
+        self.catchq = catcher.CatchQueue(prefilter=True)
+        ob = catcher.REMatch('^CREATE TABLE ', muffle=True)
+        block = catcher.REMatch('.*BEGIN .* now', muffle=True)
+        block.end = catcher.TextMatch('END')
+        plain = catcher.REMatch('.', listen=True) # no literals
+        for (x) in (ob, block, plain):
+            self.catchq.add(x)
+        # a literal start fails fast in the regexp, the queue still uses it
+        self.assertFalse(isinstance(ob.start, catcher.PrefilterMatch))
+        self.assertTrue(isinstance(block.start, catcher.PrefilterMatch))
+        self.assertFalse(isinstance(plain.start, catcher.PrefilterMatch))
+        self.assertEqual(self.catchq.line('nothing here'), 'nothing here')
+        self.assertEqual(self.catchq.line('CREATE TABLE x'), '')
+        self.assertEqual(self.catchq.line('TABLE BEGIN'), 'TABLE BEGIN')
+        self.assertEqual(self.catchq.line('BEGIN it now'), '')
+        # mid-capture catchers are never skipped
+        self.assertEqual(self.catchq.line('nothing here'), '')
+        self.assertEqual(self.catchq.line('END'), '')
+        stats = self.catchq.prefilter_stats()
+        self.assertEqual(stats['queue_skipped'], 6)
+        self.assertEqual(stats['skipped'], 6)
+        self.assertEqual(stats['regexp_calls'], 1) # block's start
+        # the shared prefilter is rebuilt when the catchers change
+        self.catchq.rm(ob)
+        self.assertEqual(self.catchq.line('CREATE TABLE x'), 'CREATE TABLE x')
+
+    def test_prefilter_after_filter(self):
+        self.catchq = catcher.CatchQueue(prefilter=True)
+        rename = catcher.TextCatcher('foo', filter=True, replace='CREATE TABLE foo')
+        ob = catcher.REMatch('^CREATE TABLE ', muffle=True)
+        self.catchq.add(rename, 10)
+        self.catchq.add(ob, 20)
+        self.assertEqual(self.catchq.line('foo'), '')
+        self.assertEqual(self.catchq.line('bar'), 'bar')
+        self.assertEqual(self.catchq.prefilter_stats()['queue_skipped'], 1)
+
+    def test_unhashable(self):
+        alias = catcher.Alias(alias_from='ls', alias_to='dir') # defines __eq__
+        ob = catcher.REMatch('^CREATE TABLE ', muffle=True)
+        for (catchq) in (catcher.CatchQueue(prefilter=True),
+                         catcher.CatchQueue(budget=1.0),
+                         catcher.CatchQueue(cache_size=10)):
+            catchq.add(ob)
+            catchq.add(alias)
+            self.assertEqual(catchq.line('ls -l'), 'dir -l\n')
+            self.assertEqual(catchq.line('CREATE TABLE x'), '')
+            catchq.replace([alias], carry=True)
+            self.assertEqual(catchq.line('ls'), 'dir\n')
+
+    def test_budget(self):
+        clock = [0.0]
+        class Slow(CatcherAPI):
+            cost = 0.0
+            def line(self, txt):
+                clock[0] += self.cost
+                CatcherAPI.line(self, txt)
+        quarantined = []
+        with mock.patch.object(catcher, 'cpu_clock', lambda: clock[0]):
+            self.catchq = catcher.CatchQueue(budget=1.0, budget_window=10.0,
+                                             on_quarantine=quarantined.append)
+            slow, fast, unlimited = Slow(), Slow(), Slow()
+            slow.cost = 0.4
+            unlimited.budget = 100.0
+            unlimited.cost = 0.4
+            for (ob) in (slow, fast, unlimited):
+                self.catchq.add(ob)
+            self.catchq.line('a')
+            self.catchq.line('b')
+            self.assertEqual(quarantined, [])
+            self.catchq.line('c') # 1.2 > 1.0
+            self.assertEqual(quarantined, [slow])
+            self.assertEqual(len(self.catchq), 2)
+            self.assertEqual(slow.lines, []) # reset when quarantined
+            self.catchq.line('d')
+            self.assertEqual(slow.lines, [])
+            self.assertEqual(fast.lines, ['d'])
+
+            # the old window slides out
+            self.catchq.reinstate(slow)
+            self.assertEqual(len(self.catchq), 3)
+            clock[0] = 25.0 # the fresh window starts at the next line
+            for (x) in range(2):
+                self.catchq.line('e')
+            clock[0] = 40.0 # half of the last window is still counted
+            self.catchq.line('f')
+            self.assertEqual(quarantined, [slow])
+            self.catchq.line('g') # 0.4 + 0.4 + 0.8/2 > 1.0
+            self.assertEqual(quarantined, [slow, slow])
+
+            # rm and done clean up quarantined catchers too
+            self.catchq.rm(slow)
+            self.assertEqual(self.catchq.quarantined, [])
+            self.assertRaises(ValueError, self.catchq.reinstate, slow)
+            self.catchq.quarantine(fast)
+            self.catchq.done()
+            self.assertEqual(self.catchq.quarantined, [])
+
+    def test_budget_thread_clock(self):
+        # the clock of the thread that adds the catchers says nothing about
+        # the dispatching thread's clock, windows start on the first line
+        clock = [300.0]
+        class Slow(CatcherAPI):
+            def line(self, txt):
+                clock[0] += 0.2
+                CatcherAPI.line(self, txt)
+        with mock.patch.object(catcher, 'cpu_clock', lambda: clock[0]):
+            self.catchq = catcher.CatchQueue(budget=1.0, budget_window=10.0)
+            slow = Slow()
+            self.catchq.add(slow)
+            clock[0] = 0.0
+            for (x) in range(10):
+                self.catchq.line('x')
+                clock[0] += 5.0 # 0.2 every half window stays under 1.0
+            self.assertEqual(len(self.catchq), 1)
+
+    def test_cache(self):
+        class CountingMatch(catcher.TextMatch):
+            calls = 0
+            def match(self, line):
+                self.calls += 1
+                return catcher.TextMatch.match(self, line)
+        def make(text, **opts):
+            ob = catcher.Catcher(**opts)
+            ob.start = ob.end = CountingMatch(text)
+            ob.parse = make_return_x(text.upper())
+            return ob
+        self.catchq = catcher.CatchQueue(cache_size=2)
+        noise = make('noise', muffle=True)
+        fix = make('fix', filter=True)
+        other = make('zzz', listen=True)
+        for (ob) in (noise, fix, other):
+            self.catchq.add(ob)
+        for (x) in range(5):
+            self.assertEqual(self.catchq.line('noise'), '')
+            self.assertEqual(self.catchq.line('fix it'), 'FIX')
+        self.assertEqual((self.catchq.cache_misses, self.catchq.cache_hits), (2, 8))
+        # misses match once to record and then start and end match in
+        # Catcher.line, hits only run the catchers that started
+        self.assertEqual(noise.start.calls, 3 + 4 * 2 + 1)
+        self.assertEqual(fix.start.calls, 3 + 4 * 2)
+        # after a filter the line has changed, so later catchers always run
+        self.assertEqual(other.start.calls, 5)
+
+        # LRU eviction
+        self.catchq.line('a')
+        self.catchq.line('fix it')
+        self.catchq.line('b')
+        self.assertEqual(list(self.catchq.cache), ['fix it', 'b'])
+
+        # add/rm invalidate
+        self.catchq.rm(fix)
+        self.assertFalse(self.catchq.cache)
+        self.assertEqual(self.catchq.line('fix it'), 'fix it')
+        self.catchq.add(fix)
+        self.assertFalse(self.catchq.cache)
+        self.assertEqual(self.catchq.line('fix it'), 'FIX')
+
+        # no caching while a catcher is mid-match
+        block = catcher.Catcher(listen=True)
+        block.start = catcher.TextMatch('BEGIN')
+        block.end = catcher.TextMatch('END')
+        block.parse = nullfunc
+        self.catchq.add(block)
+        self.catchq.line('BEGIN')
+        self.assertTrue(self.catchq.busy)
+        misses = self.catchq.cache_misses
+        self.catchq.line('fix it')
+        self.catchq.line('fix it')
+        self.assertEqual(block.lines, ['BEGIN', 'FIX', 'FIX'])
+        self.assertEqual(self.catchq.cache_misses, misses)
+        self.catchq.line('END')
+        self.assertFalse(self.catchq.busy)
+        self.assertEqual(self.catchq.line('fix it'), 'FIX')
+        self.assertEqual(self.catchq.cache_misses, misses + 1)
+
+    def test_cache_budget(self):
+        # the queue's own start match on a miss is charged to the catcher
+        clock = [0.0]
+        class SlowMatch(catcher.TextMatch):
+            def match(self, line):
+                clock[0] += 0.4
+                return catcher.TextMatch.match(self, line)
+        quarantined = []
+        with mock.patch.object(catcher, 'cpu_clock', lambda: clock[0]):
+            self.catchq = catcher.CatchQueue(cache_size=10, budget=1.0,
+                                             on_quarantine=quarantined.append)
+            ob = catcher.Catcher(listen=True)
+            ob.start = ob.end = SlowMatch('never')
+            self.catchq.add(ob)
+            for (x) in 'abc':
+                self.catchq.line(x)
+            self.assertEqual(quarantined, [ob])
+
+    def test_add_many(self):
+        obs = [CatcherAPI() for (x) in range(4)]
+        self.catchq.add_many([obs[0], (obs[1], 10), (obs[2], 200)], priority=50)
+        self.catchq.add(obs[3], 50)
+        self.assertEqual([wr() for (wr) in self.catchq.obs],
+                         [obs[1], obs[0], obs[3], obs[2]])
+
+    def test_replace(self):
+        def block(tag):
+            ob = catcher.Catcher(listen=True)
+            ob.start = catcher.TextMatch('BEGIN')
+            ob.end = catcher.TextMatch('END')
+            ob.parse = nullfunc
+            ob.tags.add(tag)
+            return ob
+        old, other = block('old'), block('other')
+        self.catchq.add_many([old, other])
+        self.catchq.line('BEGIN')
+        new = [block('new'), (other, 10)]
+        self.catchq.replace(new)
+        self.assertTrue(self.catchq.pending)
+        self.assertEqual(len(self.catchq.prioritized_obs), 2) # not yet
+        self.catchq.line('middle')
+        self.assertEqual([wr() for (wr) in self.catchq.obs], [other, new[0]])
+        self.assertEqual(old.lines, ['BEGIN']) # dropped mid-match
+        self.assertEqual(other.lines, ['BEGIN', 'middle']) # kept its state
+
+        # with carry the old catcher finishes its match and then goes away
+        ends = []
+        new[0].add_callback(ends.append)
+        self.catchq.line('BEGIN')
+        newer = [block('newer')]
+        self.catchq.replace(newer, carry=True)
+        del new
+        self.catchq.line('more')
+        self.assertEqual(len(self.catchq), 3) # other and new are carried
+        self.assertEqual(len(self.catchq.retiring), 2)
+        self.catchq.line('END')
+        self.assertEqual(len(ends), 1)
+        self.assertEqual(ends[0].tags, set(['new']))
+        self.assertEqual(self.catchq.obs[0]().tags, set(['newer']))
+        self.assertEqual(len(self.catchq), 1)
+        self.assertFalse(self.catchq.retiring)
+
+        # catchers collected before they were installed are skipped
+        self.catchq = catcher.CatchQueue(budget=1.0)
+        self.catchq.replace([block('gone'), newer[0]])
+        self.assertFalse(self.catchq.budgets) # not until install
+        self.assertEqual(self.catchq.line('x'), 'x')
+        self.assertEqual(self.catchq.obs[0]().tags, set(['newer']))
+        self.assertEqual(len(self.catchq.budgets), 1)
+
     def test_str(self):
         # make some minimum guarantees about __str__
         self.assertTrue(getattr(self.catchq, '__str__', None) != None)
@@ -213,6 +483,162 @@ class TestCatchQ(unittest.TestCase):
         self.assertTrue(self.catchq.__class__.__name__ in str(self.catchq))
 
 
+class TestShardedCatchQ(unittest.TestCase):
+    def make_catchers(self):
+        block = catcher.Catcher(muffle=True)
+        block.start = catcher.TextMatch('BEGIN')
+        block.end = catcher.TextMatch('END')
+        return [(catcher.TextCatcher('debug', muffle=True), 10),
+                (Shout('error', filter=True), 20),
+                (Shout('warn', filter=True, count=2), 30),
+                (block, 40)]
+
+    def run_queue(self, catchq, lines):
+        obs = self.make_catchers()
+        for (ob, priority) in obs:
+            catchq.add(ob, priority)
+        try:
+            return catchq.line_many(lines)
+        finally:
+            catchq.done()
+
+    def test_matches_catchq(self):
+        lines = ['debug a', 'error b', 'warn c', 'BEGIN', 'warn d', 'END',
+                 'warn e', 'warn f', 'plain', 'debug error']
+        expected = self.run_queue(catcher.CatchQueue(), lines)
+        for (workers) in (1, 2, 3):
+            catchq = catcher.ShardedCatchQueue(workers=workers, chunk_lines=3)
+            self.assertEqual(self.run_queue(catchq, lines), expected)
+        self.assertEqual(expected[:3], ['', 'ERROR B', 'WARN C'])
+        self.assertEqual(expected[6:8], ['warn e', 'warn f']) # count ran out
+
+    def test_stacking(self):
+        # filtered lines reach lower priorities filtered, muffled lines
+        # don't reach them at all
+        def run(catchq):
+            obs = [catcher.TextCatcher('a', filter=True, replace='b'),
+                   catcher.TextCatcher('b', filter=True, replace='c'),
+                   catcher.TextCatcher('m', muffle=True),
+                   catcher.TextCatcher('m', filter=True, replace='M', count=1)]
+            catchq.add_many(obs)
+            try:
+                return catchq.line_many(['a', 'm', 'xm', 'b'])
+            finally:
+                catchq.done()
+        expected = run(catcher.CatchQueue())
+        self.assertEqual(expected, ['c', '', '', 'c'])
+        for (workers) in (2, 4):
+            catchq = catcher.ShardedCatchQueue(workers=workers, chunk_lines=1)
+            self.assertEqual(run(catchq), expected)
+
+    def test_len(self):
+        catchq = catcher.ShardedCatchQueue(workers=2)
+        obs = [Shout('x', filter=True, count=1), Shout('y', filter=True)]
+        catchq.add_many(obs)
+        self.assertEqual(len(catchq), 2)
+        self.assertEqual(catchq.line_many(['x', 'x']), ['X', 'x'])
+        self.assertEqual(len(catchq), 1)
+        catchq.done()
+
+    def test_done(self):
+        # done() runs in the workers only
+        catchq = catcher.ShardedCatchQueue(workers=2)
+        ob = Finishing('x', listen=True)
+        catchq.add(ob)
+        catchq.line('x')
+        catchq.done()
+        self.assertEqual(ob.dones, 0)
+        self.assertEqual(len(catchq), 0)
+
+    def test_errors(self):
+        errors = []
+        catchq = catcher.ShardedCatchQueue(workers=2, handle_exception=errors.append)
+        obs = [Finishing('X', listen=True), Finishing('Y', listen=True)]
+        catchq.add_many([(obs[0], 10), (obs[1], 20)])
+        # the second worker's error is on an earlier line
+        self.assertEqual(catchq.line_many(['Y fail 1', 'X fail 2']),
+                         ['Y fail 1', 'X fail 2'])
+        catchq.done()
+        self.assertEqual([str(e) for (e) in errors], ['Y fail 1', 'X fail 2'])
+
+    def test_add_after_start(self):
+        catchq = catcher.ShardedCatchQueue(workers=1)
+        self.assertEqual(catchq.line('text'), 'text')
+        self.assertRaises(RuntimeError, catchq.add, catcher.Catcher(listen=1))
+        catchq.done()
+        self.assertFalse(catchq.procs)
+
+class TestStreamCatchQ(unittest.TestCase):
+    def setUp(self):
+        self.catchq = catcher.StreamCatchQueue()
+        self.block = catcher.Catcher(muffle=True)
+        self.block.start = catcher.TextMatch('BEGIN')
+        self.block.end = catcher.TextMatch('END')
+        self.blocks = []
+        self.block.add_callback(lambda ob: self.blocks.append(list(ob.lines)))
+        self.catchq.add(self.block)
+
+    def tearDown(self):
+        self.catchq.done()
+
+    def test_interleaved(self):
+        line = self.catchq.line
+        self.assertEqual(line(1, 'hello'), 'hello')
+        self.assertFalse(self.catchq.streams) # no state for idle streams
+        self.assertEqual(line(1, 'BEGIN 1'), '')
+        self.assertEqual(line(2, 'BEGIN 2'), '')
+        self.assertEqual(line(3, 'other'), 'other')
+        self.assertEqual(sorted(self.catchq.streams), [1, 2])
+        self.assertEqual(line(2, 'END 2'), '')
+        self.assertEqual(line(1, 'more 1'), '')
+        self.assertEqual(line(1, 'END 1'), '')
+        self.assertEqual(self.blocks, [['BEGIN 2', 'END 2'],
+                                       ['BEGIN 1', 'more 1', 'END 1']])
+        self.assertFalse(self.catchq.streams)
+        self.assertEqual(self.block.lines, []) # the definition is untouched
+
+    def test_unhashable(self):
+        alias = catcher.Alias(alias_from='ls', alias_to='dir') # defines __eq__
+        self.catchq.add(alias)
+        self.assertEqual(self.catchq.line(1, 'ls -l'), 'dir -l\n')
+        self.assertEqual(self.catchq.line(1, 'BEGIN'), '')
+        self.assertEqual(self.catchq.line(1, 'END'), '')
+
+    def test_start_matched_once(self):
+        calls = []
+        match = self.block.start.match
+        self.block.start.match = lambda line: calls.append(line) or match(line)
+        self.catchq.line(1, 'BEGIN')
+        self.catchq.line(1, 'END')
+        self.assertEqual(calls, ['BEGIN'])
+        self.assertEqual(self.blocks, [['BEGIN', 'END']])
+
+    def test_count(self):
+        self.block.count = 1
+        self.catchq.line_many([(1, 'BEGIN END'), (2, 'BEGIN')])
+        # stream 1 used up its count, so it keeps a state to remember it
+        self.assertEqual(self.catchq.line(1, 'BEGIN'), 'BEGIN')
+        self.assertEqual(self.catchq.streams[1][id(self.catchq.obs[0])].count, 0)
+        self.assertEqual(self.catchq.line(2, 'END'), '')
+        self.assertEqual(len(self.catchq), 1)
+        self.catchq.done_stream(1)
+        self.assertFalse(1 in self.catchq.streams)
+
+    def test_rm(self):
+        self.catchq.line(1, 'BEGIN')
+        self.catchq.rm(self.block)
+        self.assertFalse(self.catchq.streams)
+        self.assertEqual(self.catchq.line(1, 'END'), 'END')
+
+    def test_replace(self):
+        self.catchq.line(1, 'BEGIN')
+        self.assertRaises(ValueError, self.catchq.replace, [self.block], carry=True)
+        new = catcher.TextCatcher('x', muffle=True)
+        self.catchq.replace([new])
+        self.assertEqual(self.catchq.line(1, 'more'), 'more')
+        self.assertFalse(self.catchq.streams)
+        self.assertEqual(self.catchq.line(1, 'x'), '')
+
 class TestCatcher(unittest.TestCase):
 
     def test_interface(self):
@@ -382,6 +808,110 @@ class TestCatcher(unittest.TestCase):
             assert v == 1, (k, v)
 
         return
+    def test_batch_callbacks(self):
+        batches = []
+        ob = catcher.Catcher(listen=1)
+        ob.start = ob.end = AlwaysMatch()
+        ob.parse = lambda: ob.lines[0].upper()
+        batch = catcher.BatchCallback(batches.append, size=3)
+        ob.add_callback(batch, 'batch')
+        for (x) in 'abcd':
+            ob.data['x'] = x
+            ob.line(x)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([r.lines for (r) in batches[0]], [['a'], ['b'], ['c']])
+        self.assertEqual([r.output for (r) in batches[0]], ['A', 'B', 'C'])
+        self.assertEqual(batches[0][0].data, {'x': 'a'})
+        self.assertEqual(len(batch.results), 1)
+
+        # done flushes, also through a CatchQueue
+        catchq = catcher.CatchQueue()
+        catchq.add(ob)
+        catchq.done()
+        self.assertEqual([r.lines for (r) in batches[1]], [['d']])
+
+        # age
+        with mock.patch.object(time, 'time', lambda: now[0]):
+            now = [0.0]
+            batch.age = 10
+            ob.line('e')
+            now[0] = 5.0
+            batch.poll()
+            ob.line('f')
+            self.assertEqual(len(batches), 2)
+            now[0] = 10.0
+            batch.poll()
+            self.assertEqual([r.lines for (r) in batches[2]], [['e'], ['f']])
+
+        # the plain function form, removed by the function
+        ob.clear_callbacks()
+        ob.add_callback(batches.append, 'batch')
+        self.assertTrue(isinstance(ob.callbacks[0][1], catcher.BatchCallback))
+        ob.line('g')
+        ob.rm_callback(batches.append) # flushes
+        self.assertEqual(ob.callbacks, [])
+        self.assertEqual([r.lines for (r) in batches[3]], [['g']])
+
+        # and by the BatchCallback itself
+        batch = catcher.BatchCallback(batches.append)
+        ob.add_callback(batch, 'batch')
+        ob.line('h')
+        ob.rm_callback(batch)
+        self.assertEqual(ob.callbacks, [])
+        self.assertEqual([r.lines for (r) in batches[4]], [['h']])
+
+    def test_batch_callbacks_queue(self):
+        batches = []
+        ob = catcher.Catcher(listen=1, count=2)
+        ob.start = ob.end = AlwaysMatch()
+        batch = catcher.BatchCallback(batches.append, age=10)
+        ob.add_callback(batch, 'batch')
+        catchq = catcher.CatchQueue()
+        catchq.add(ob)
+        # the queue polls after each batch of lines
+        with mock.patch.object(time, 'time', lambda: now[0]):
+            now = [0.0]
+            catchq.line_many(['a'])
+            self.assertEqual(batches, [])
+            now[0] = 10.0
+            catchq.line_many([])
+            self.assertEqual([[r.lines for (r) in b] for (b) in batches], [[['a']]])
+        # running out of count removes and flushes it
+        catchq.line('b')
+        self.assertEqual(len(catchq), 0)
+        self.assertEqual([r.lines for (r) in batches[1]], [['b']])
+        # so does rm
+        catchq.add(ob)
+        ob.count = 2
+        ob.line('c')
+        catchq.rm(ob)
+        self.assertEqual([r.lines for (r) in batches[2]], [['c']])
+
+        # line() polls too, now and then
+        start = time.time()
+        with mock.patch.object(time, 'time', lambda: now[0]):
+            now = [start + 100.0]
+            catchq.add(ob)
+            ob.count = -1
+            ob.start = ob.end = catcher.TextMatch('d')
+            catchq.line('d')
+            now[0] += 10.0
+            self.assertEqual(len(batches), 3)
+            catchq.line('x')
+            self.assertEqual([r.lines for (r) in batches[3]], [['d']])
+
+        # leaving a queue only flushes, the catcher may be in another one
+        dones = []
+        ob.done = lambda: dones.append(ob)
+        other = catcher.CatchQueue()
+        other.add(ob)
+        catchq.line('d')
+        catchq.rm(ob)
+        self.assertEqual([r.lines for (r) in batches[4]], [['d']])
+        self.assertEqual(dones, [])
+        other.done()
+        self.assertEqual(dones, [ob])
+
     def test_data_api(self):
         ob = catcher.Catcher(listen=1)
         self.assertRaises(KeyError, ob.__getitem__, 'foo')
@@ -526,6 +1056,65 @@ class TestConcreteCatchers(unittest.TestCase):
         self.assertRaises(ParseCalled, ob.line, 'hello')
         self.assertRaises(ParseCalled, ob.line, 'xxx hello yyy')
 
+    def test_alias(self):
+        ob = catcher.Alias(alias_from='n', alias_to='north')
+        catchq = catcher.CatchQueue()
+        catchq.add(ob)
+        self.assertEqual(catchq.line('n 2'), 'north 2\n')
+        self.assertEqual(catchq.line('s 2'), 's 2')
+
+    def test_prefix_match(self):
+        ob = catcher.PrefixMatch(['ab', 'abc'])
+        self.assertFalse(ob.match('xabc'))
+        self.assertEqual(ob.prefix, None)
+        self.assertTrue(ob.match('abcd'))
+        self.assertEqual(ob.prefix, 'abc') # longest wins
+        ob.rm('abc')
+        self.assertTrue(ob.match('abcd'))
+        self.assertEqual(ob.prefix, 'ab')
+        self.assertEqual(ob.lengths, [2])
+        ob.rm('ab')
+        self.assertFalse(ob.match('abcd'))
+        self.assertRaises(ValueError, ob.add, '')
+
+    def test_alias_table(self):
+        ob = catcher.AliasTable({'n': 'north', 'ne': 'northeast'})
+        self.assertEqual(ob.action, 'filter')
+        catchq = catcher.CatchQueue()
+        catchq.add(ob)
+        self.assertEqual(catchq.line('n 2\n'), 'north 2\n')
+        self.assertEqual(catchq.line('ne 2\n'), 'northeast 2\n')
+        self.assertEqual(catchq.line('s 2\n'), 's 2\n')
+        # runtime changes
+        ob.add('s', 'south')
+        self.assertEqual(catchq.line('s 2\n'), 'south 2\n')
+        ob.rm('ne')
+        self.assertEqual(catchq.line('ne 2\n'), 'northe 2\n')
+        self.assertEqual(len(ob.aliases), 2)
+
+    def test_required_literals(self):
+        for (pattern, literals) in [('^CREATE TABLE ', ['CREATE TABLE ']),
+                                    ('ERROR .* timeout', [' timeout', 'ERROR ']),
+                                    ('a|b', []),
+                                    ('(?i)abc', []),
+                                    ('(?i:ab)cd', ['cd']),
+                                    ('(foo)+bar?', ['foo', 'ba']),
+                                    ('x{0,3}y', ['y'])]:
+            regexp = catcher.re.compile(pattern)
+            self.assertEqual(catcher.required_literals(regexp), literals)
+
+        ob = catcher.REMatch('\\w+ ERROR .* timeout', listen=True)
+        self.assertTrue(isinstance(ob.start, catcher.PrefilterMatch))
+        self.assertEqual(ob.start.pattern, '\\w+ ERROR .* timeout')
+        self.assertFalse(ob.start.match('an ERROR no time'))
+        self.assertFalse(ob.start.match('an  ERROR x timeout'))
+        self.assertTrue(ob.start.match('an ERROR with timeout'))
+        self.assertEqual((ob.start.calls, ob.start.skipped), (2, 1))
+        # patterns starting with a literal aren't wrapped
+        for (pattern) in ('ERROR .* timeout', '^ERROR .* timeout'):
+            ob = catcher.REMatch(pattern, listen=True)
+            self.assertFalse(isinstance(ob.start, catcher.PrefilterMatch))
+
     def test_re_match(self):
         ob = catcher.REMatch('hel+o', listen=True)
         class ParseCalled(Exception): pass
@@ -534,5 +1123,217 @@ class TestConcreteCatchers(unittest.TestCase):
         self.assertRaises(ParseCalled, ob.line, 'helo')
         self.assertRaises(ParseCalled, ob.line, 'helllllo')
 
+class TestCompiledCatchQ(unittest.TestCase):
+    specs = [
+        {'kind': 'REMatch', 'action': 'muffle', 'pattern': '^DEBUG', 'priority': 10},
+        {'kind': 'TextCatcher', 'action': 'filter', 'pattern': 'err', 'replace': 'ERR'},
+        {'kind': 'TextCatcher', 'action': 'filter', 'pattern': 'ERR', 'replace': 'E!',
+         'count': 2},
+        {'kind': 'LineCatcher', 'action': 'muffle', 'pattern': 'BEGIN', 'end': 'END'},
+        {'kind': 'REMatch', 'action': 'filter', 'pattern': 'x(\\d)', 'replace': 'y\\1',
+         'expects': 3},
+        {'kind': 'TextCatcher', 'action': 'listen', 'pattern': 'a', 'end': 'b',
+         'priority': 1},
+        {'kind': 'LineCatcher', 'action': 'filter', 'pattern': 'ok', 'replace': 'OK',
+         'count': 1},
+    ]
+    lines = ['DEBUG err', 'err', 'an err', 'err again', 'BEGIN', 'err', 'END',
+             'x1', 'x2 err', 'x3', 'x4', 'ok', 'ok', 'a', 'DEBUG', 'b', 'c']
+
+    def interpreted(self, specs, lines):
+        catchq, catchers = catcher.make_queue(specs)
+        return catchq.line_many(lines), catchers
+
+    def test_same_output(self):
+        expected, catchers = self.interpreted(self.specs, self.lines)
+        catchq = catcher.CompiledCatchQueue(self.specs)
+        self.assertEqual(catchq.line_many(self.lines), expected)
+        self.assertEqual(expected[:4], ['', 'E!', 'an E!', 'ERR again'])
+        self.assertEqual(len(catchq), 5) # both counted catchers ran out
+        self.assertEqual(catchq.matches[0], 2)
+        self.assertEqual(catchq.matches[5], 1) # listeners still count
+
+        # and line by line, one spec at a time
+        for (spec) in self.specs:
+            expected, catchers = self.interpreted([spec], self.lines)
+            catchq = catcher.CompiledCatchQueue([spec])
+            self.assertEqual([catchq.line(line) for (line) in self.lines], expected)
+
+    def test_stacked_filters(self):
+        specs = [{'kind': 'TextCatcher', 'action': 'filter', 'pattern': 'text',
+                  'replace': 'textA'},
+                 {'kind': 'TextCatcher', 'action': 'filter', 'pattern': 'textA',
+                  'replace': 'textB'}]
+        catchq = catcher.CompiledCatchQueue(specs)
+        self.assertEqual(catchq.line('text'), 'textB')
+
+    def test_cache(self):
+        first = catcher.CompiledCatchQueue(self.specs)
+        second = catcher.CompiledCatchQueue([dict(spec) for (spec) in self.specs])
+        self.assertEqual(first.line.__code__, second.line.__code__)
+        first.line('BEGIN')
+        self.assertEqual(second.line('x'), 'x') # state isn't shared
+        first.done()
+        self.assertEqual(len(first), 0)
+        self.assertRaises(ValueError, catcher.CompiledCatchQueue,
+                          [{'kind': 'REMatch', 'action': 'filter', 'pattern': 'x'}])
+
+    def test_cache_bounded(self):
+        with mock.patch.object(catcher, '_compiled_size', 2):
+            for (n) in range(4):
+                catchq = catcher.CompiledCatchQueue(
+                    [{'kind': 'TextCatcher', 'action': 'muffle', 'pattern': str(n)}])
+                self.assertEqual(catchq.line(str(n)), '')
+            self.assertTrue(len(catcher._compiled) <= 2)
+
+    def test_bad_specs(self):
+        injected = "muffle\n    import os; os.system('false')\n    #"
+        for (bad) in [{'kind': 'REMatch', 'action': injected, 'pattern': 'x'},
+                      {'kind': 'REMatch', 'action': 'mufle', 'pattern': 'x'},
+                      {'kind': 'Catcher', 'action': 'muffle', 'pattern': 'x'},
+                      {'kind': 'REMatch', 'action': 'muffle', 'pattern': 1},
+                      {'kind': 'REMatch', 'action': 'muffle', 'pattern': 'x',
+                       'count': '1'}]:
+            self.assertRaises(ValueError, catcher.CompiledCatchQueue, [bad])
+
+class TestCLI(unittest.TestCase):
+    config = [
+        '# drop debug output',
+        'REMatch muffle,priority=10 ^DEBUG',
+        '',
+        'TextCatcher filter error => ERROR',
+        'LineCatcher filter ok => OK',
+        'REMatch filter,count=1 x (\\d+) => x <\\1>',
+    ]
+    text = 'DEBUG 1\nan error\nok\nnot ok\nx 12 y 3\nx 12\n'
+    expected = 'an ERROR\nOK\nnot ok\nx <12> y 3\nx 12\n'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def read(self, path):
+        with io.open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def test_load_specs(self):
+        specs = catcher.load_specs(self.config)
+        self.assertEqual(len(specs), 4)
+        self.assertEqual(specs[0], {'kind': 'REMatch', 'action': 'muffle',
+                                    'priority': 10, 'pattern': '^DEBUG'})
+        self.assertEqual(specs[2]['pattern'], 'ok')
+        self.assertEqual(specs[2]['replace'], 'OK')
+        for (bad) in ['REMatch muffle', 'Nope muffle x', 'REMatch eat x',
+                      'REMatch muffle,bogus=1 x', 'REMatch filter x']:
+            self.assertRaises(ValueError, catcher.load_specs, [bad])
+        self.assertRaises(ValueError, catcher.make_catcher,
+                          {'kind': 'REMatch', 'action': 'filter', 'pattern': 'x'})
+
+    def test_sub(self):
+        self.assertEqual(catcher.TextMatch('a').sub('b', 'aXa'), 'bXb')
+        self.assertEqual(catcher.LineMatch('a').sub('b', 'a'), 'b')
+        self.assertEqual(catcher.LineMatch('a').sub('b', 'aa'), 'aa')
+        self.assertFalse(catcher.LineMatch('a').match('a\n'))
+        self.assertFalse(catcher.LineMatch('').match('\n'))
+        # for config catchers line endings are kept but don't count
+        self.assertEqual(catcher.FileLineMatch('a').sub('b', 'a\r\n'), 'b\r\n')
+        self.assertTrue(catcher.FileLineMatch('a').match('a\n'))
+        self.assertFalse(catcher.FileLineMatch('a').match('a\nb'))
+        ob = catcher.make_catcher({'kind': 'LineCatcher', 'action': 'listen',
+                                   'pattern': 'a', 'end': 'b'})
+        self.assertTrue(ob.start.match('a\n') and ob.end.match('b\n'))
+        ob = catcher.REMatch('a+', filter=True, replace='b')
+        self.assertRaises(catcher.Filter, ob.line, 'aaxa')
+
+    def test_last_line(self):
+        # the last line of a file may not have a newline
+        queue, catchers = catcher.make_queue(catcher.load_specs(self.config))
+        outfile = io.StringIO()
+        catcher.process(queue, io.StringIO('ok\nok'), outfile)
+        self.assertEqual(outfile.getvalue(), 'OK\nOK')
+        compiled = catcher.CompiledCatchQueue(catcher.load_specs(self.config))
+        self.assertEqual(compiled.line_many(['ok\n', 'ok', 'ok\r\n', 'okay']),
+                         ['OK\n', 'OK', 'OK\r\n', 'okay'])
+
+    def test_process(self):
+        queue, catchers = catcher.make_queue(catcher.load_specs(self.config))
+        outfile = io.StringIO()
+        stats = catcher.process(queue, io.StringIO(self.text), outfile, 8)
+        self.assertEqual(outfile.getvalue(), self.expected)
+        self.assertEqual(stats.lines_in, 6)
+        self.assertEqual(stats.lines_out, 5)
+        self.assertEqual(stats.chars_in, len(self.text))
+        self.assertTrue('6 lines in' in str(stats))
+
+    def test_read_ahead(self):
+        infile = io.StringIO(self.text * 10)
+        batches = list(catcher.read_ahead(infile, 8, 2))
+        self.assertTrue(len(batches) > 2)
+        self.assertEqual(''.join(sum(batches, [])), self.text * 10)
+        queue, catchers = catcher.make_queue(catcher.load_specs(self.config))
+        outfile = io.StringIO()
+        catcher.process(queue, io.StringIO(self.text), outfile, 8, readahead=1)
+        self.assertEqual(outfile.getvalue(), self.expected)
+        class Broken(object):
+            def readlines(self, size):
+                raise IOError('broken')
+        self.assertRaises(IOError, list, catcher.read_ahead(Broken(), 8, 2))
+
+    def test_read_ahead_stops(self):
+        threads = threading.active_count()
+        class Failing(object):
+            def line_many(self, lines):
+                raise ValueError('fail')
+        infile = io.StringIO(self.text * 100)
+        self.assertRaises(ValueError, catcher.process, Failing(), infile,
+                          io.StringIO(), 8, readahead=1)
+        self.assertEqual(threading.active_count(), threads)
+        # closing the generator early stops the reader too
+        batches = catcher.read_ahead(io.StringIO(self.text * 100), 8, 1)
+        next(batches)
+        batches.close()
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_compressed(self):
+        config = self.write('config', '\n'.join(self.config))
+        openers = [('gz', gzip.open), ('bz2', bz2.open)]
+        try:
+            import lzma
+            openers.append(('xz', lzma.open))
+        except ImportError:
+            pass
+        inputs = []
+        for (ext, opener) in openers:
+            path = os.path.join(self.tmpdir, 'in.' + ext)
+            with opener(path, 'wb') as f:
+                f.write(self.text.encode('utf-8'))
+            inputs.append(path)
+        output = os.path.join(self.tmpdir, 'out')
+        for (readahead) in ('0', '2'):
+            argv = ['-q', '-c', config, '-o', output, '-r', readahead, '-j', '2'] + inputs
+            self.assertEqual(catcher.main(argv), 0)
+            self.assertEqual(self.read(output), self.expected * len(inputs))
+
+    def test_main(self):
+        config = self.write('config', '\n'.join(self.config))
+        inputs = [self.write('in%d' % (i), self.text) for (i) in range(3)]
+        for (jobs) in ('1', '2'):
+            output = os.path.join(self.tmpdir, 'out')
+            argv = ['-q', '-c', config, '-o', output, '-j', jobs] + inputs
+            self.assertEqual(catcher.main(argv), 0)
+            # every file gets a fresh queue, so count=1 is per file either way
+            expected = self.expected * 3
+            self.assertEqual(self.read(output), expected)
+            self.assertEqual(catcher.main(argv + ['--compile']), 0)
+            self.assertEqual(self.read(output), expected)
+
 if __name__ == '__main__':
     unittest.main()
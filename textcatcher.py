@@ -1,8 +1,32 @@
 # python imports
 import re
 import weakref
+import copy
+import collections
 import operator
 import time
+import sys
+import io
+import os
+import shutil
+import tempfile
+import argparse
+import threading
+import gzip
+import bz2
+try:
+  import queue as Queue
+except ImportError: # python 2
+  import Queue
+try:
+  import lzma
+except ImportError: # python < 3.3, no .xz support
+  lzma = None
+try:
+  from re import _parser as sre_parse, _constants as sre_constants
+except ImportError: # python < 3.11
+  import sre_parse, sre_constants
+import multiprocessing
 
 """Some basic classes that know how to read, and possibly swallow output
    Cather: a class the takes input to be acted on, listened to, or munged
@@ -29,16 +53,114 @@ class CatchQueue(object):
       to the original object creator to keep them alive.  This is so misbehaving
       or buggy owners don't leave Catchers around in a bad state.
   """
+  poll_interval = 1.0 # seconds between line()'s polls of batch callbacks
 
-  def __init__(self, handle_exception=None):
+  def __init__(self, handle_exception=None, prefilter=False,
+               budget=None, budget_window=10.0, on_quarantine=None,
+               cache_size=0):
     self.prioritized_obs = []
     self.handle_exception = handle_exception
+    # catchers with a budget (their own, or this default) that use more
+    # than budget CPU seconds per budget_window are moved from the dispatch
+    # list to self.quarantined until reinstate() is called
+    self.budget = budget
+    self.budget_window = budget_window
+    self.on_quarantine = on_quarantine
+    self.budgets = {} # id(weakref) -> TimeBudget, catchers may not be hashable
+    self.quarantined = [] # (priority, weakref) pairs
+    # if prefilter is true the required literals of all the regexp
+    # catchers are combined into one regexp that is searched once per line,
+    # when it doesn't match none of those catchers can start.  prefilter_obs
+    # holds the id()s of their weakrefs, catchers may not be hashable.
+    self.prefilter = prefilter
+    self.prefilter_regexp = None
+    self.prefilter_obs = None
+    self.prefilter_skipped = 0
+    # with a cache_size, line() remembers which catchers started on each
+    # recent line.  While every catcher is idle a repeat of that line only
+    # runs those catchers, so all start matchers must be pure functions
+    # of the line (regexps, TextMatch, ...)
+    self.cache_size = cache_size
+    self.cache = collections.OrderedDict() # line -> [weakref, ...]
+    self.busy = set() # id()s of the weakrefs of catchers in the middle of a match
+    self.cache_hits = 0
+    self.cache_misses = 0
+    # replace() leaves the new dispatch list here for line() to install,
+    # carried over catchers stay in retiring until they finish their match
+    self.pending = None
+    self.retiring = {} # id(weakref) -> catcher, strong refs for carried catchers
+    self.next_poll = 0.0 # time line() next polls the batch callbacks
     return
 
   def add(self, ob, priority = 100):
+    self.add_many([(ob, priority)])
+    return
+
+  def _entry(self, item, priority, budgets):
+    """ the (priority, weakref) pair for an add_many() item, its budget
+        goes in budgets """
+    if isinstance(item, tuple):
+      ob, priority = item
+    else:
+      ob = item
     ob_ref = weakref.ref(ob, self.rm)
-    self.prioritized_obs.append((priority, ob_ref))
+    budget = getattr(ob, 'budget', None) or self.budget
+    if budget:
+      budgets[id(ob_ref)] = TimeBudget(budget, self.budget_window)
+    return (priority, ob_ref)
+
+  def add_many(self, obs, priority = 100):
+    """ add catchers, or (catcher, priority) pairs, sorting only once """
+    self.prioritized_obs.extend([self._entry(item, priority, self.budgets)
+                                 for (item) in obs])
     self.prioritized_obs.sort(key=operator.itemgetter(0))
+    self.changed()
+    return
+
+  def replace(self, obs, priority = 100, carry=False):
+    """ swap in a whole new set of catchers (like add_many's obs).  The new
+        dispatch list is built here and installed by line() before the next
+        line, so replace() can run in another thread while lines are going
+        through.  With carry, old catchers in the middle of a match keep
+        going until that match is finished and are dropped after.
+    """
+    budgets = {} # merged by install(), on the thread that owns self.budgets
+    new_obs = [self._entry(item, priority, budgets) for (item) in obs]
+    new_obs.sort(key=operator.itemgetter(0))
+    old_obs = None
+    if carry: # keep the old catchers alive until install() can look at them
+      old_obs = [wr() for (pri, wr) in self.prioritized_obs]
+    self.pending = (new_obs, old_obs, budgets)
+    return
+
+  def install(self):
+    """ install the catchers from the last replace() now """
+    new_obs, old_obs, budgets = self.pending
+    self.pending = None
+    # new catchers may have been collected since replace()
+    new_obs = [(pri, wr) for (pri, wr) in new_obs if wr() is not None]
+    new_ids = set(id(wr()) for (pri, wr) in new_obs)
+    dropped = []
+    carry = set()
+    if old_obs is not None:
+      carry = set(id(wr) for (pri, wr) in self.prioritized_obs)
+    for (pri, wr) in self.prioritized_obs + self.quarantined:
+      ob = wr()
+      if ob is None or id(ob) in new_ids:
+        continue
+      if id(wr) in carry and getattr(ob, 'lines', None):
+        new_obs.append((pri, wr))
+        self.retiring[id(wr)] = ob
+      else:
+        dropped.append(ob)
+    new_obs.sort(key=operator.itemgetter(0))
+    self.prioritized_obs = new_obs
+    self.quarantined[:] = []
+    self.budgets.update(budgets)
+    self.prune()
+    self.changed()
+    for (ob) in dropped:
+      _flush_callbacks(ob)
     return
 
   def expire_weakrefs(self):
@@ -56,32 +178,180 @@ class CatchQueue(object):
 
   def rm(self, ob):
     """ remove ob from this catcher.  ob can be either the original object,
-        a weakref to that object, or a tag string """
+        a weakref to that object, or a tag string.  Removed catchers that
+        are still alive have their batch callbacks flushed """
     self.expire_weakrefs()
-    new_obs = []
-    for pri, wr in self.prioritized_obs:
-      keep = True
+    def keep(wr):
       if wr() is None: # expired
-        keep = False
+        return False
       elif ob is wr or ob is wr(): # object or weakref identify
-        keep = False
+        return False
+      elif isinstance(ob, weakref.ref): # dead weakrefs can't be hashed
+        return True
       elif hasattr(wr(), 'tags') and ob in wr().tags: # matching tag
-        keep = False
-      if keep:
-        new_obs.append((pri, wr))
-    self.prioritized_obs[:] = new_obs
+        return False
+      return True
+    removed = [wr() for (pri, wr) in self.prioritized_obs + self.quarantined
+               if not keep(wr) and wr() is not None]
+    self.prioritized_obs[:] = [pair for (pair) in self.prioritized_obs if keep(pair[1])]
+    self.quarantined[:] = [pair for (pair) in self.quarantined if keep(pair[1])]
+    self.prune()
+    self.changed()
+    for (removed_ob) in removed:
+      _flush_callbacks(removed_ob)
+    return
+
+  def prune(self):
+    """ drop the per-catcher state of catchers that are no longer queued """
+    live = set(id(wr) for (pri, wr) in self.prioritized_obs + self.quarantined)
+    for (state) in (self.budgets, self.retiring):
+      for (key) in list(state):
+        if key not in live:
+          del state[key]
+    return
+
+  def changed(self):
+    """ the dispatch list changed, drop everything derived from it """
+    self.prefilter_obs = None
+    self.cache.clear()
+    if self.cache_size:
+      self.busy = set(id(wr) for (pri, wr) in self.prioritized_obs
+                      if wr() is not None and getattr(wr(), 'lines', None))
+    return
+
+  def _pop(self, pairs, ob):
+    for (i, (pri, wr)) in enumerate(pairs):
+      if ob is wr or ob is wr():
+        return pairs.pop(i)
+    raise ValueError("%r not in queue" % (ob,))
+
+  def quarantine(self, ob):
+    """ stop dispatching to ob (the object or its weakref) until it is
+        reinstated, on_quarantine is called with the object.  A match in
+        progress is dropped, it would be stale by the time it is back """
+    pri, wr = self._pop(self.prioritized_obs, ob)
+    wr().reset()
+    self.quarantined.append((pri, wr))
+    self.changed()
+    if self.on_quarantine:
+      self.on_quarantine(wr())
+    return
+
+  def reinstate(self, ob):
+    """ put a quarantined ob back with its old priority and a fresh budget """
+    pri, wr = self._pop(self.quarantined, ob)
+    self.prioritized_obs.append((pri, wr))
+    self.prioritized_obs.sort(key=operator.itemgetter(0))
+    self.changed()
+    if id(wr) in self.budgets:
+      self.budgets[id(wr)] = TimeBudget(self.budgets[id(wr)].limit, self.budget_window)
     return
 
+  def build_prefilter(self):
+    literals = set()
+    self.prefilter_obs = set()
+    for obref in self.obs:
+      start = getattr(obref(), 'start', None)
+      if isinstance(start, PrefilterMatch):
+        required = start.literals
+      elif isinstance(start, regexp_type):
+        required = required_literals(start)
+      else:
+        continue
+      if required:
+        literals.add(required[0])
+        self.prefilter_obs.add(id(obref))
+    self.prefilter_regexp = None
+    if literals:
+      self.prefilter_regexp = re.compile('|'.join(map(re.escape, sorted(literals))))
+    return
+
+  def prefilter_stats(self):
+    """ regexp calls made and skipped thanks to the literal prefilters,
+        queue_skipped is the part skipped by this queue's shared prefilter """
+    calls = skipped = 0
+    for obref in self.obs:
+      start = getattr(obref(), 'start', None)
+      if isinstance(start, PrefilterMatch):
+        calls += start.calls
+        skipped += start.skipped
+    return {'regexp_calls' : calls,
+            'skipped' : skipped + self.prefilter_skipped,
+            'queue_skipped' : self.prefilter_skipped}
+
   def input_many(self, lines):
     """Like input(), but never returns a value"""
     for (line) in lines:
       self.line(line)
+    self.poll()
+    return
+
+  def line_many(self, lines):
+    """Like input_many(), but returns the list of output lines"""
+    out = [self.line(line) for (line) in lines]
+    self.poll()
+    return out
+
+  def poll(self):
+    """ flush batch callbacks whose oldest result is too old.  Called
+        after every input_many()/line_many() and by line() every
+        poll_interval seconds, a feed that stops sending lines altogether
+        needs its caller to call it """
+    self.next_poll = time.time() + self.poll_interval
+    for obref in self.obs:
+      poll_callbacks = getattr(obref(), 'poll_callbacks', None)
+      if poll_callbacks is not None:
+        poll_callbacks()
     return
 
   def line(self, line):
+    if self.pending is not None:
+      self.install()
+    if time.time() >= self.next_poll:
+      self.poll()
     ret = None
     remove = []
-    for obref in self.obs:
+    retiring = self.retiring
+    skip = ()
+    if self.prefilter:
+      if self.prefilter_obs is None:
+        self.build_prefilter()
+      if self.prefilter_regexp is not None and not self.prefilter_regexp.search(line):
+        skip = self.prefilter_obs
+    budgets = self.budgets
+    slow = []
+    obs = None
+    record = None # the catchers that may start on this line, for the cache
+    if self.cache_size and not self.busy:
+      obs = self.cache.pop(line, None)
+      if obs is None:
+        self.cache_misses += 1
+        record = []
+      else:
+        self.cache_hits += 1
+        self.cache[line] = obs # most recently used
+    if obs is None:
+      obs = self.obs
+    orig = line
+    for obref in obs:
+      # the prefilter only saw the line as given, not what filters made of it
+      if id(obref) in skip and line is orig and _stock_line(obref()) and not obref().lines:
+        self.prefilter_skipped += 1
+        continue
+      budget = budgets and budgets.get(id(obref))
+      if budget:
+        started = cpu_clock()
+      if record is not None:
+        if line is orig and _stock_line(obref()) and not obref().lines:
+          # see for ourselves if it starts, it is a no-op if it doesn't,
+          # but the start match still counts against the budget
+          if not obref().start.match(line):
+            if budget:
+              now = cpu_clock()
+              if budget.spend(now - started, now):
+                slow.append(obref)
+            continue
+        record.append(obref)
       try:
         ob = obref()
         ob.line(line)
@@ -99,11 +369,28 @@ class CatchQueue(object):
           self.handle_exception(e)
           ob.reset()
       finally:
-        if ob.count == 0:
+        if budget:
+          now = cpu_clock()
+          if budget.spend(now - started, now):
+            slow.append(obref)
+        if ob.count == 0 or (retiring and id(obref) in retiring and not ob.lines):
           remove.append(obref)
+        if self.cache_size:
+          if getattr(ob, 'lines', None):
+            self.busy.add(id(obref))
+          else:
+            self.busy.discard(id(obref))
 
+    if record is not None and not remove:
+      self.cache[orig] = record
+      if len(self.cache) > self.cache_size:
+        self.cache.popitem(last=False)
     for ob in remove:
       self.rm(ob)
+    removed = set(map(id, remove))
+    for obref in slow:
+      if obref() is not None and id(obref) not in removed:
+        self.quarantine(obref)
     return line
 
   def __len__(self):
@@ -116,9 +403,371 @@ class CatchQueue(object):
     return outstr
 
   def done(self):
-    for obref in self.obs:
-      obref().done()
+    if self.pending is not None:
+      self.install()
+    for obref in self.obs + [pair[1] for (pair) in self.quarantined]:
+      if obref() is not None:
+        obref().done()
     self.prioritized_obs[:] = []
+    self.quarantined[:] = []
+    self.budgets.clear()
+    self.retiring.clear()
+    self.changed()
+    return
+
+def _flush_callbacks(ob):
+  """ hand on what the batch callbacks of a catcher leaving a queue hold,
+      done() is left for when the catcher's owner is done with it """
+  flush_callbacks = getattr(ob, 'flush_callbacks', None)
+  if flush_callbacks is not None:
+    flush_callbacks()
+  return
+
+def _stock_line(ob):
+  """ True if ob.line() is Catcher.line(), which does nothing while idle
+      unless start.match() is true """
+  return (isinstance(ob, Catcher) and 'line' not in ob.__dict__
+          and '_line' not in ob.__dict__ and type(ob).line is Catcher.line
+          and type(ob)._line is Catcher._line)
+
+# the clock catcher budgets are measured with, the CPU time of this thread
+# where we can, so other threads don't count against a catcher
+cpu_clock = (getattr(time, 'thread_time', None) or getattr(time, 'process_time', None)
+             or time.clock)
+
+class TimeBudget(object):
+  """ CPU seconds a catcher is allowed per window seconds.  Usage over the
+      sliding window is estimated from the current fixed window plus the
+      overlapping part of the previous one, so it costs O(1) per call.
+      Windows are measured on cpu_clock() too.  cpu_clock() is per thread,
+      so the first window starts at the first spend(), on the thread that
+      dispatches lines, not on the thread that made the budget.
+  """
+  def __init__(self, limit, window):
+    self.limit = limit
+    self.window = window
+    self.window_start = None
+    self.used = 0.0
+    self.prev_used = 0.0
+    return
+
+  def spend(self, secs, now):
+    """ record secs used at time now, returns True if over budget """
+    if self.window_start is None:
+      self.window_start = now
+    elif now - self.window_start >= self.window:
+      periods = int((now - self.window_start) // self.window)
+      self.prev_used = self.used if periods == 1 else 0.0
+      self.used = 0.0
+      self.window_start += periods * self.window
+    self.used += secs
+    return self.spent(now) > self.limit
+
+  def spent(self, now):
+    if self.window_start is None:
+      return self.used
+    overlap = 1.0 - (now - self.window_start) / self.window
+    return self.prev_used * max(overlap, 0.0) + self.used
+
+class StreamCatchQueue(CatchQueue):
+  """ a CatchQueue for many interleaved streams that share one set of
+      catchers.  Input is line(stream_id, text).  The catchers added to the
+      queue are only used as definitions, when one starts matching on a
+      stream it is copied and the copy keeps that stream's lines, data,
+      and count.  Copies are dropped again as soon as they are idle and
+      back to the definition's count and data, so memory grows with the
+      number of active captures and not with streams * catchers.
+  """
+
+  def __init__(self, handle_exception=None):
+    CatchQueue.__init__(self, handle_exception)
+    # stream_id -> {id(catcher weakref): per-stream copy}, catchers may
+    # not be hashable
+    self.streams = {}
+    return
+
+  def new_state(self, ob):
+    state = copy.copy(ob)
+    state.lines = []
+    state.data = dict(ob.data)
+    state.history = []
+    return state
+
+  def rm(self, ob):
+    CatchQueue.rm(self, ob)
+    self.prune_streams()
+    return
+
+  def replace(self, obs, priority = 100, carry=False):
+    """ like CatchQueue.replace(), the captures in progress on each stream
+        are dropped with the old catchers, carry is not supported """
+    if carry:
+      raise ValueError("StreamCatchQueue can't carry per-stream captures")
+    CatchQueue.replace(self, obs, priority)
+    return
+
+  def install(self):
+    CatchQueue.install(self)
+    self.prune_streams()
+    return
+
+  def prune_streams(self):
+    """ drop per-stream state of catchers that are no longer queued """
+    live = set(id(pair[1]) for (pair) in self.prioritized_obs)
+    for (stream_id, states) in list(self.streams.items()):
+      for (key) in list(states):
+        if key not in live:
+          _flush_callbacks(states.pop(key))
+      if not states:
+        del self.streams[stream_id]
+    return
+
+  def input_many(self, pairs):
+    """ like CatchQueue.input_many(), but takes (stream_id, line) pairs """
+    for (stream_id, line) in pairs:
+      self.line(stream_id, line)
+    self.poll()
+    return
+
+  def line_many(self, pairs):
+    out = [self.line(stream_id, line) for (stream_id, line) in pairs]
+    self.poll()
+    return out
+
+  def line(self, stream_id, line):
+    if self.pending is not None:
+      self.install()
+    if time.time() >= self.next_poll:
+      self.poll()
+    states = self.streams.get(stream_id)
+    for obref in self.obs:
+      ob = obref()
+      state = None
+      matched = False
+      if states is not None:
+        state = states.get(id(obref))
+      if state is None:
+        # idle on this stream, only pay for the start match
+        if not ob.start.match(line):
+          continue
+        state = self.new_state(ob)
+        if states is None:
+          states = self.streams[stream_id] = {}
+        states[id(obref)] = state
+        matched = _stock_line(state)
+      elif state.count == 0:
+        continue
+      try:
+        if matched:
+          state.start_line(line)
+        else:
+          state.line(line)
+      except Muffle:
+        line = ''
+        break
+      except Filter as e:
+        line = e.line
+        continue
+      except Exception as e:
+        if not self.handle_exception:
+          state.reset()
+          raise
+        else:
+          self.handle_exception(e)
+          state.reset()
+      finally:
+        # negative counts never expire, so only a positive count is state
+        if (not state.lines and (state.count < 0 or state.count == ob.count)
+            and state.data == ob.data):
+          del states[id(obref)]
+        if not states:
+          del self.streams[stream_id]
+          states = None
+    return line
+
+  def done_stream(self, stream_id):
+    """ the stream is closed, call done() on its catchers and forget it """
+    for state in self.streams.pop(stream_id, {}).values():
+      state.done()
+    return
+
+  def done(self):
+    for (stream_id) in list(self.streams):
+      self.done_stream(stream_id)
+    CatchQueue.done(self)
+    return
+
+def _shard_worker(inconn, outconn, shard):
+  """ worker process loop for ShardedCatchQueue.  shard is the list of
+      catchers for one contiguous range of priorities, in priority order.
+      Each batch is (lines, muffled, errors, live): lines muffled by an
+      earlier stage are in the muffled set and skipped, lines filtered by
+      an earlier stage arrive already filtered.  We add our own muffles,
+      filters, and (lineno, exception) errors, append the number of our
+      catchers still live, and pass the batch on to the next stage.
+  """
+  while True:
+    msg = inconn.recv()
+    if msg[0] == 'done':
+      for (ob) in shard:
+        ob.done()
+      outconn.send(msg)
+      break
+    lines, muffled, errors, live = msg[1:]
+    for (lineno, text) in enumerate(lines):
+      if lineno in muffled:
+        continue
+      expired = False
+      for (ob) in shard:
+        try:
+          ob.line(text)
+        except Muffle:
+          muffled.add(lineno)
+          break
+        except Filter as e:
+          text = e.line
+          continue
+        except Exception as e:
+          ob.reset()
+          errors.append((lineno, e))
+        finally:
+          if ob.count == 0:
+            expired = True
+      lines[lineno] = text
+      if expired:
+        for (ob) in shard:
+          if ob.count == 0:
+            _flush_callbacks(ob)
+        shard = [ob for (ob) in shard if ob.count != 0]
+    for (ob) in shard:
+      poll_callbacks = getattr(ob, 'poll_callbacks', None)
+      if poll_callbacks is not None:
+        poll_callbacks()
+    live.append(len(shard))
+    outconn.send(('batch', lines, muffled, errors, live))
+  inconn.close()
+  outconn.close()
+  return
+
+class ShardedCatchQueue(CatchQueue):
+  """ a CatchQueue that splits its catchers across worker processes.  The
+      catchers are cut into contiguous priority ranges, one per worker, and
+      the workers are chained into a pipeline: every batch of lines goes
+      through the highest priority worker first, which muffles and filters
+      it exactly the way CatchQueue.line would before passing it on.  A
+      batch of lines is split into chunks that are fed in from a thread so
+      all the workers are busy with different chunks at the same time.
+
+      Catchers must be added before start() (or the first line) and live in
+      the workers from then on, so callbacks run in the worker processes,
+      and done() runs there too.  Unlike CatchQueue an exception doesn't
+      stop a batch: every line of it still goes through every catcher, and
+      without handle_exception the error of the earliest line is raised
+      once the batch is through, losing that batch's output.
+  """
+
+  def __init__(self, workers=2, handle_exception=None, chunk_lines=1000):
+    CatchQueue.__init__(self, handle_exception)
+    self.workers = workers
+    self.chunk_lines = chunk_lines
+    self.procs = []
+    self.inconn = None # to the first worker
+    self.outconn = None # from the last worker
+    self.live = [] # live catchers per worker, as of the last batch
+    return
+
+  def add_many(self, obs, priority = 100):
+    if self.procs:
+      raise RuntimeError("can't add catchers to a started ShardedCatchQueue")
+    CatchQueue.add_many(self, obs, priority)
+    return
+
+  def replace(self, obs, priority = 100, carry=False):
+    if self.procs:
+      raise RuntimeError("can't replace catchers in a started ShardedCatchQueue")
+    CatchQueue.replace(self, obs, priority, carry)
+    return
+
+  def start(self):
+    """ fork the workers, each getting the next range of priorities """
+    if self.pending is not None:
+      self.install()
+    obs = [obref() for (obref) in self.obs]
+    size = -(-len(obs) // self.workers) or 1
+    shards = [obs[i:i + size] for (i) in range(0, max(len(obs), 1), size)]
+    self.live = [len(shard) for (shard) in shards]
+    self.inconn, conn = multiprocessing.Pipe()
+    for (shard) in shards:
+      child_in = conn
+      conn, child_out = multiprocessing.Pipe()
+      proc = multiprocessing.Process(target=_shard_worker,
+                                     args=(child_in, child_out, shard))
+      proc.daemon = True
+      proc.start()
+      child_in.close()
+      child_out.close()
+      self.procs.append(proc)
+    self.outconn = conn
+    return
+
+  def line_many(self, lines):
+    lines = list(lines)
+    if not lines:
+      return []
+    if not self.procs:
+      self.start()
+    chunks = [lines[i:i + self.chunk_lines]
+              for (i) in range(0, len(lines), self.chunk_lines)]
+    # a separate feeder so a full pipe to the first worker can't deadlock
+    # with the last worker waiting for us to read its output
+    def feed():
+      for (chunk) in chunks:
+        self.inconn.send(('batch', chunk, set(), [], []))
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    output = []
+    errors = []
+    for (chunk) in chunks:
+      msg = self.outconn.recv()
+      chunk_lines, muffled, chunk_errors, self.live = msg[1:]
+      # later stages report later, put the errors back in line order
+      for (lineno, e) in sorted(chunk_errors, key=operator.itemgetter(0)):
+        errors.append(e)
+      for (lineno) in muffled:
+        chunk_lines[lineno] = ''
+      output.extend(chunk_lines)
+    feeder.join()
+    for (e) in errors:
+      if not self.handle_exception:
+        raise e
+      self.handle_exception(e)
+    return output
+
+  def line(self, line):
+    return self.line_many([line])[0]
+
+  def input_many(self, lines):
+    self.line_many(lines)
+    return
+
+  def __len__(self):
+    if self.procs:
+      return sum(self.live)
+    return CatchQueue.__len__(self)
+
+  def done(self):
+    if self.procs:
+      self.inconn.send(('done',))
+      self.outconn.recv()
+      for (proc) in self.procs:
+        proc.join()
+      self.inconn.close()
+      self.outconn.close()
+      self.procs[:] = []
+      # the workers called done() on their copies, ours never saw a line
+      self.prioritized_obs[:] = []
+    CatchQueue.done(self)
     return
 
 class Catcher(object):
@@ -136,9 +785,10 @@ class Catcher(object):
       self.add_callback(func, 'start') # call for normal start match
       self.add_callback(func, 'parse')   # call for normal finish _before_ parse
       self.add_callback(func, 'end')   # call for normal finish _after_ parse
+      self.add_callback(func, 'batch') # call with a list of Results, see BatchCallback
       func will be called with this object as its only argument
   """
-  callback_types = ['start', 'parse', 'end']
+  callback_types = ['start', 'parse', 'end', 'batch']
 
   def __init__(self, **opts):
     # calc pass-through or muffle
@@ -155,8 +805,11 @@ class Catcher(object):
 
     if opts.get('count', None):
       self.count = opts['count']
+    self.replace = opts.get('replace', None)
+    self.budget = opts.get('budget', None) # see CatchQueue
 
     self.data = {}
+    self.output = None # what parse() returned for the last match
     self.callbacks = []
     self.lines = []
     self.history = [] # list of timestamps of last 10 times the catcher matched
@@ -170,8 +823,11 @@ class Catcher(object):
     return
 
   def parse(self):
-    ''' empty parse by default '''
-    pass
+    ''' empty parse by default, unless the catcher was given a replace
+        option.  Then the output is the captured text with every start
+        match replaced, like re.sub() '''
+    if self.replace is not None:
+      return self.start.sub(self.replace, ''.join(self.lines))
 
   def line(self, text):
     try:
@@ -180,11 +836,19 @@ class Catcher(object):
       self.reset()
     return
 
-  def _line(self, text):
+  def start_line(self, text):
+    """ like line(), for a text the caller already knows start matches """
+    try:
+      self._line(text, matched=True)
+    except AbortMatch:
+      self.reset()
+    return
+
+  def _line(self, text, matched=False):
     started = False # True if we just started on this line
     if not self.lines:
       # there is only one way to start, return true from self.start.match
-      if self.start.match(text): # 'start' regexp-alike
+      if matched or self.start.match(text): # 'start' regexp-alike
         started = True
         self.lines.append(text)
         self.do_callbacks('start')
@@ -218,9 +882,10 @@ class Catcher(object):
       return
 
     self.do_callbacks('parse')
-    output = self.parse()
+    output = self.output = self.parse()
     self.update_history()
     self.do_callbacks('end')
+    self.do_callbacks('batch')
     self.reset()
     self.count -= 1
 
@@ -235,16 +900,40 @@ class Catcher(object):
 
   def add_callback(self, func, when='end', priority=0):
     assert when in self.callback_types, when
+    if when == 'batch' and not isinstance(func, BatchCallback):
+      func = BatchCallback(func)
     self.callbacks.append((priority, func, when))
     self.callbacks.sort(key=operator.itemgetter(0)) # sorts by priority
     return
 
   def clear_callbacks(self):
+    self.flush_callbacks()
     self.callbacks[:] = []
     return
 
   def rm_callback(self, func):
-    self.callbacks = [tup for (tup) in self.callbacks if tup[1] != func]
+    keep = []
+    for (tup) in self.callbacks:
+      if tup[1] == func or (isinstance(tup[1], BatchCallback) and tup[1].func == func):
+        if isinstance(tup[1], BatchCallback):
+          tup[1].flush()
+      else:
+        keep.append(tup)
+    self.callbacks = keep
+    return
+
+  def flush_callbacks(self):
+    """ hand any results the batch callbacks are holding to their funcs """
+    for pri, func, kind in self.callbacks:
+      if kind == 'batch':
+        func.flush()
+    return
+
+  def poll_callbacks(self):
+    """ let the batch callbacks flush results that have waited too long """
+    for pri, func, kind in self.callbacks:
+      if kind == 'batch':
+        func.poll()
     return
 
   def do_callbacks(self, when):
@@ -259,7 +948,9 @@ class Catcher(object):
       out += "%s:%s," % (str(k), str(v))
     return out
 
-  def done(self): pass
+  def done(self):
+    self.flush_callbacks()
+    return
 
   def update_history(self):
     now = time.ctime()
@@ -273,6 +964,54 @@ class Catcher(object):
   def __contains__(self, k):
     return (k in self.data)
 
+class Result(object):
+  """ what a catcher had when it finished a match, see BatchCallback """
+  def __init__(self, ob):
+    self.lines = list(ob.lines)
+    self.data = dict(ob.data)
+    self.output = ob.output
+    return
+
+class BatchCallback(object):
+  """ a 'batch' callback that collects a Result for every finished match
+      and calls func with a list of them.  It flushes when it has size
+      results, when a result arrives and the oldest is age seconds old
+      (or when poll() is called and it is, which the queues do after every
+      line_many() and every poll_interval seconds of line() calls), and when
+      the catcher is done or leaves a queue.
+      One BatchCallback can be shared by many catchers.
+        ob.add_callback(db.insert_many, 'batch') # defaults
+        ob.add_callback(BatchCallback(db.insert_many, size=1000, age=5), 'batch')
+  """
+  def __init__(self, func, size=100, age=None):
+    self.func = func
+    self.size = size
+    self.age = age
+    self.results = []
+    self.first = None # time of the oldest result
+    return
+
+  def __call__(self, ob):
+    if not self.results:
+      self.first = time.time()
+    self.results.append(Result(ob))
+    if len(self.results) >= self.size:
+      self.flush()
+    else:
+      self.poll()
+    return
+
+  def poll(self):
+    if self.results and self.age is not None and time.time() - self.first >= self.age:
+      self.flush()
+    return
+
+  def flush(self):
+    if self.results:
+      results, self.results = self.results, []
+      self.func(results)
+    return
+
 class CallAndResponse(object):
   def __init__(self, call, response):
     self.call = call
@@ -296,7 +1035,7 @@ class Alias(Catcher):
     text = "\n".join(self.lines)
     m = self.start.match(text)
     self.output = self.tothis + m.group(1) + "\n"
-    raise DoneReparse()
+    return self.output
 
   def __eq__(self, other):
     if (isinstance(other, Alias) and self.fromthis == other.fromthis):
@@ -304,6 +1043,76 @@ class Alias(Catcher):
     else:
       return 0
 
+class PrefixMatch(object):
+  """ a class that matches any of a table of literal line prefixes,
+      suitable for use in catchers.  Prefixes are grouped by length so a
+      match costs one dict lookup per distinct prefix length, no matter how
+      many prefixes there are.  The longest matching prefix wins and is
+      left in self.prefix
+  """
+  def __init__(self, prefixes=()):
+    self.prefixes = set()
+    self.lengths = [] # distinct prefix lengths, longest first
+    self.prefix = None
+    for (prefix) in prefixes:
+      self.add(prefix)
+    return
+
+  def add(self, prefix):
+    if not prefix:
+      raise ValueError("empty prefix")
+    self.prefixes.add(prefix)
+    if len(prefix) not in self.lengths:
+      self.lengths.append(len(prefix))
+      self.lengths.sort(reverse=True)
+    return
+
+  def rm(self, prefix):
+    self.prefixes.discard(prefix)
+    if not [p for (p) in self.prefixes if len(p) == len(prefix)]:
+      self.lengths = [l for (l) in self.lengths if l != len(prefix)]
+    return
+
+  def match(self, line):
+    prefixes = self.prefixes
+    for (length) in self.lengths:
+      if line[:length] in prefixes:
+        self.prefix = line[:length]
+        return True
+    self.prefix = None
+    return False
+
+class AliasTable(Catcher):
+  """ a filter Catcher that rewrites lines starting with any of a table of
+      literal prefixes.  All the aliases share one PrefixMatch so a line is
+      checked against the whole table in a single pass.
+        table = AliasTable({'n': 'north', 's': 'south'})
+        table.add('e', 'east')
+        table.rm('s')
+  """
+  expects = 1
+
+  def __init__(self, aliases=None, **opts):
+    Catcher.__init__(self, filter=1, **opts)
+    self.aliases = {}
+    self.start = self.end = PrefixMatch()
+    for (alias_from, alias_to) in (aliases or {}).items():
+      self.add(alias_from, alias_to)
+    return
+
+  def add(self, alias_from, alias_to):
+    self.aliases[alias_from] = alias_to
+    self.start.add(alias_from)
+    return
+
+  def rm(self, alias_from):
+    self.aliases.pop(alias_from, None)
+    self.start.rm(alias_from)
+    return
+
+  def parse(self):
+    prefix = self.start.prefix
+    return self.aliases[prefix] + self.lines[0][len(prefix):]
 
 class TextMatch(object):
   """ a class that matches text, suitable for use in catchers
@@ -316,6 +1125,8 @@ class TextMatch(object):
   def match(self, line):
     self.index = line.find(self.match_text)
     return self.index != -1
+  def sub(self, repl, line):
+    return line.replace(self.match_text, repl)
 
 class TextCatcher(Catcher):
   """ a Catcher that matches if the text appears anywhere in a line """
@@ -323,10 +1134,28 @@ class TextCatcher(Catcher):
     Catcher.__init__(self, **opts)
     self.start = self.end = TextMatch(text)
 
+line_endings = ('', '\n', '\r\n')
+
 class LineMatch(TextMatch):
   """ a Catcher that matches text for the whole line. """
   def match(self, line):
     return self.match_text == line
+  def sub(self, repl, line):
+    if self.match_text == line:
+      return repl
+    return line
+
+class FileLineMatch(LineMatch):
+  """ a LineMatch for lines read from files, which end in a line ending
+      (except maybe the last one).  The ending doesn't count and sub()
+      keeps it.  Used for the LineCatchers of a config. """
+  def match(self, line):
+    text = self.match_text
+    return line.startswith(text) and line[len(text):] in line_endings
+  def sub(self, repl, line):
+    if self.match(line):
+      return repl + line[len(self.match_text):]
+    return line
 
 class LineCatcher(Catcher):
   """ a Catcher that matches if the line is equal to text """
@@ -334,11 +1163,537 @@ class LineCatcher(Catcher):
     Catcher.__init__(self, **opts)
     self.start = self.end = LineMatch(text)
 
+def required_literals(regexp):
+  """ returns the literal strings that any match of the compiled regexp must
+      contain, longest first.  Case insensitive parts contribute nothing. """
+  if not isinstance(regexp.pattern, str) or regexp.flags & re.IGNORECASE:
+    return []
+  try:
+    parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+  except Exception:
+    return []
+  def walk(parsed):
+    runs = []
+    run = []
+    for (op, av) in parsed:
+      if op is sre_constants.LITERAL:
+        run.append(chr(av))
+        continue
+      if op is sre_constants.AT: # anchors don't consume anything
+        continue
+      runs.append(''.join(run))
+      run = []
+      if op is sre_constants.SUBPATTERN:
+        if len(av) == 4 and av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+          continue
+        runs.extend(walk(av[-1]))
+      elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+        runs.extend(walk(av[2]))
+    runs.append(''.join(run))
+    return runs
+  return sorted(set(filter(None, walk(parsed))), key=len, reverse=True)
+
+def prefilter_literals(regexp):
+  """ the required literals worth checking before regexp.match(), none if
+      the pattern starts with a literal: match() then fails on the first
+      character of most lines, faster than we could check anything """
+  try:
+    parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+  except Exception:
+    return []
+  for (op, av) in parsed:
+    if op is not sre_constants.AT:
+      if op is sre_constants.LITERAL:
+        return []
+      break
+  return required_literals(regexp)
+
+regexp_type = type(re.compile(''))
+
+class PrefilterMatch(object):
+  """ a compiled regexp wrapper for use in catchers.  match() only calls
+      the regexp if every literal a match requires is in the line, which
+      is much cheaper than running the regexp on lines that can't match.
+      Everything else is passed through to the regexp.  calls counts the
+      regexp calls made, skipped the ones saved.
+  """
+  def __init__(self, regexp, literals):
+    self.regexp = regexp
+    self.literals = literals
+    self.calls = 0
+    self.skipped = 0
+    return
+
+  def match(self, line):
+    for (literal) in self.literals:
+      if literal not in line:
+        self.skipped += 1
+        return None
+    self.calls += 1
+    return self.regexp.match(line)
+
+  def __getattr__(self, name):
+    if name == 'regexp': # not set yet, e.g. while unpickling
+      raise AttributeError(name)
+    return getattr(self.regexp, name)
+
 class REMatch(Catcher):
   """ a Catcher that matches a regular expression """
   def __init__(self, re_text, **opts):
     Catcher.__init__(self, **opts)
     self.start = self.end = re.compile(re_text)
+    literals = prefilter_literals(self.start)
+    if literals:
+      self.start = self.end = PrefilterMatch(self.start, literals)
     self.orig_regexp = re_text
     return
 
+
+# building catchers from specs, and the command line interface
+catcher_kinds = {
+  'REMatch' : REMatch,
+  'TextCatcher' : TextCatcher,
+  'LineCatcher' : LineCatcher,
+}
+matcher_kinds = {
+  'REMatch' : re.compile,
+  'TextCatcher' : TextMatch,
+  'LineCatcher' : FileLineMatch,
+}
+spec_options = ['count', 'priority', 'expects']
+spec_actions = ('muffle', 'filter', 'listen')
+
+def make_catcher(spec):
+  """ make a catcher from a spec dict.  A spec has a 'kind' (one of
+      catcher_kinds), an 'action', a 'pattern', and optionally 'replace'
+      (for filters), 'count', 'end' (a pattern of the same kind),
+      'expects', and 'priority' (used by whoever adds it)
+  """
+  cls = catcher_kinds[spec['kind']]
+  opts = {spec['action'] : True}
+  if 'count' in spec:
+    opts['count'] = spec['count']
+  if 'replace' in spec:
+    opts['replace'] = spec['replace']
+  if spec['action'] == 'filter' and opts.get('replace') is None:
+    raise ValueError("filter spec needs a replace: %r" % (spec,))
+  ob = cls(spec['pattern'], **opts)
+  if spec['kind'] == 'LineCatcher': # the lines will come with their endings
+    ob.start = ob.end = FileLineMatch(spec['pattern'])
+  if 'end' in spec:
+    ob.end = matcher_kinds[spec['kind']](spec['end'])
+  if 'expects' in spec:
+    ob.expects = spec['expects']
+  return ob
+
+# spec key -> (source, factory, the factory's arguments other than state),
+# least recently used first
+_compiled = collections.OrderedDict()
+_compiled_size = 100
+
+def _spec_key(specs):
+  return tuple(tuple(sorted(spec.items())) for (spec) in specs)
+
+def _check_spec(spec):
+  """ raise ValueError unless spec is safe to generate code from """
+  if spec.get('kind') not in catcher_kinds:
+    raise ValueError("unknown kind: %r" % (spec,))
+  if spec.get('action') not in spec_actions:
+    raise ValueError("unknown action: %r" % (spec,))
+  for (k) in ('pattern', 'end', 'replace'):
+    if k in spec and not isinstance(spec[k], str):
+      raise ValueError("%s must be a string: %r" % (k, spec))
+  if not isinstance(spec.get('pattern'), str):
+    raise ValueError("spec needs a pattern: %r" % (spec,))
+  if spec['action'] == 'filter' and spec.get('replace') is None:
+    raise ValueError("filter spec needs a replace: %r" % (spec,))
+  for (k) in spec_options:
+    if k in spec and not isinstance(spec[k], int):
+      raise ValueError("%s must be an int: %r" % (k, spec))
+  return
+
+def _gen_catcher(i, spec):
+  """ the source lines for one catcher inside the generated dispatch(), and
+      the names it needs bound in the enclosing factory """
+  kind = spec['kind']
+  action = spec['action']
+  pattern = spec['pattern']
+  names = {}
+  # a catcher whose end is its start finishes on the line that starts it
+  single = ('end' not in spec or spec['end'] == pattern) and spec.get('expects', 1) <= 1
+  # (start test, end test, sub expression) for each kind
+  if kind == 'REMatch':
+    names['start_%d' % i] = re.compile(pattern)
+    if not single:
+      names['end_%d' % i] = re.compile(spec.get('end', pattern))
+    start = 'start_%d.match(line)' % i
+    literals = prefilter_literals(names['start_%d' % i])
+    if literals:
+      start = '(%s and %s)' % (' and '.join(['%r in line' % (l,) for (l) in literals]), start)
+    end = 'end_%d.match(line)' % i
+    sub = 'start_%d.sub(%r, text)' % (i, spec.get('replace'))
+  elif kind == 'TextCatcher':
+    start = '%r in line' % (pattern,)
+    end = '%r in line' % (spec.get('end', pattern),)
+    sub = 'text.replace(%r, %r)' % (pattern, spec.get('replace'))
+  elif kind == 'LineCatcher':
+    is_line = '(%s.startswith(%r) and %s[%d:] in ' + repr(line_endings) + ')'
+    end_pattern = spec.get('end', pattern)
+    start = is_line % ('line', pattern, 'line', len(pattern))
+    end = is_line % ('line', end_pattern, 'line', len(end_pattern))
+    sub = '(%r + text[%d:] if %s else text)' % (
+      spec.get('replace'), len(pattern), is_line % ('text', pattern, 'text', len(pattern)))
+  else:
+    raise ValueError("unknown kind %r" % (kind,))
+  if 'expects' in spec:
+    end = 'len(held_%d) >= %d or %s' % (i, spec['expects'], end)
+
+  src = ['    # %d: %r %r %r' % (i, kind, action, pattern)]
+  if single:
+    src.append('    if counts[%d] and %s:' % (i, start))
+    finish = '      '
+    if action == 'filter':
+      src.append(finish + 'text = line')
+  else:
+    names['held_%d' % i] = []
+    src.append('    if counts[%d] and (held_%d or %s):' % (i, i, start))
+    src.append('      held_%d.append(line)' % i)
+    src.append('      if %s:' % end)
+    finish = '        '
+    if action == 'filter':
+      src.append(finish + "text = ''.join(held_%d)" % i)
+    src.append('        del held_%d[:]' % i)
+  src.append(finish + 'counts[%d] -= 1' % i)
+  src.append(finish + 'matches[%d] += 1' % i)
+  if action == 'muffle':
+    src.append(finish + "return ''")
+  elif action == 'filter':
+    src.append(finish + 'line = %s' % sub)
+  if not single and action in ('muffle', 'filter'):
+    src.append("      else:")
+    src.append("        return ''")
+  return src, names
+
+def _gen_queue(specs):
+  """ generate the source of a factory that takes the compiled patterns and
+      state as arguments and returns a dispatch(line) closure over them """
+  body = []
+  names = {}
+  for (i, spec) in specs:
+    src, spec_names = _gen_catcher(i, spec)
+    body.extend(src)
+    names.update(spec_names)
+  args = ', '.join(['counts', 'matches'] + sorted(names))
+  src = ['def make(%s):' % args,
+         '  def dispatch(line):'] + body + [
+         '    return line',
+         '  return dispatch']
+  return '\n'.join(src) + '\n', names
+
+class CompiledCatchQueue(object):
+  """ a CatchQueue-alike generated from a list of catcher specs (see
+      make_catcher).  The whole queue is one generated function with the
+      literal tests inlined and the regexps precompiled, so there are no
+      attribute lookups, exceptions, or callbacks per line.  Generated code
+      is cached by spec so building the same queue again is cheap.  The
+      output is the same as a CatchQueue of make_catcher() catchers, but
+      there are no callbacks; self.matches counts completed matches.
+  """
+
+  def __init__(self, specs):
+    self.specs = list(specs)
+    for (spec) in self.specs:
+      _check_spec(spec)
+    key = _spec_key(self.specs)
+    cached = _compiled.pop(key, None)
+    if cached is None:
+      # stable sort by priority, like CatchQueue.add
+      ordered = sorted(enumerate(self.specs), key=lambda pair: pair[1].get('priority', 100))
+      source, names = _gen_queue(ordered)
+      namespace = {}
+      exec(compile(source, '<textcatcher %s>' % (hash(key),), 'exec'), namespace)
+      names = dict((k, v) for (k, v) in names.items() if not k.startswith('held_'))
+      cached = (source, namespace['make'], names)
+    _compiled[key] = cached # most recently used
+    if len(_compiled) > _compiled_size:
+      _compiled.popitem(last=False)
+    self.source, make, names = cached
+    self.counts = [spec.get('count') or -1 for (spec) in self.specs]
+    self.matches = [0] * len(self.specs)
+    # the lines held by multi-line catchers are per queue state
+    self.held = dict((arg, []) for (arg) in make.__code__.co_varnames
+                     if arg.startswith('held_'))
+    self.line = make(self.counts, self.matches, **dict(names, **self.held))
+    return
+
+  def line_many(self, lines):
+    return list(map(self.line, lines))
+
+  def input_many(self, lines):
+    for (line) in lines:
+      self.line(line)
+    return
+
+  def __len__(self):
+    return len([count for (count) in self.counts if count != 0])
+
+  def done(self):
+    for (held) in self.held.values():
+      del held[:]
+    self.counts[:] = [0] * len(self.counts)
+    return
+
+def load_specs(lines):
+  """ parse a catcher config into a list of spec dicts, one per line
+        # comments and blank lines are ignored
+        <kind> <action>[,<option>=<int>...] <pattern>[ => <replace>]
+      e.g.
+        REMatch muffle ^DEBUG
+        TextCatcher listen,count=3 timeout
+        LineCatcher filter,priority=10 OK => ok
+  """
+  specs = []
+  for (lineno, text) in enumerate(lines):
+    text = text.strip()
+    if not text or text.startswith('#'):
+      continue
+    parts = text.split(None, 2)
+    if len(parts) != 3:
+      raise ValueError("line %d: expected <kind> <action> <pattern>" % (lineno + 1))
+    kind, opts, pattern = parts
+    opts = opts.split(',')
+    spec = {'kind' : kind, 'action' : opts[0]}
+    if kind not in catcher_kinds:
+      raise ValueError("line %d: unknown kind %r" % (lineno + 1, kind))
+    if spec['action'] not in spec_actions:
+      raise ValueError("line %d: unknown action %r" % (lineno + 1, spec['action']))
+    for (opt) in opts[1:]:
+      k, _, v = opt.partition('=')
+      if k not in spec_options:
+        raise ValueError("line %d: unknown option %r" % (lineno + 1, k))
+      spec[k] = int(v)
+    if spec['action'] == 'filter':
+      if ' => ' not in pattern:
+        raise ValueError("line %d: filter needs '<pattern> => <replace>'" % (lineno + 1))
+      pattern, spec['replace'] = pattern.split(' => ', 1)
+    spec['pattern'] = pattern
+    specs.append(spec)
+  return specs
+
+def load_class(path):
+  """ import 'module:Class[:action]' and return an instance, the action
+      defaults to listen """
+  parts = path.split(':')
+  if len(parts) not in (2, 3):
+    raise ValueError("expected module:Class[:action], got %r" % (path,))
+  module = __import__(parts[0], fromlist=[parts[1]])
+  action = 'listen'
+  if len(parts) == 3:
+    action = parts[2]
+  return getattr(module, parts[1])(**{action : True})
+
+def make_queue(specs=(), classes=(), compiled=False):
+  """ returns a CatchQueue and the list of catchers it dispatches to, the
+      caller has to keep the catchers alive.  If compiled is true the
+      specs are compiled into a CompiledCatchQueue instead """
+  if compiled:
+    if classes:
+      raise ValueError("only spec catchers can be compiled")
+    return CompiledCatchQueue(specs), []
+  queue = CatchQueue()
+  pairs = [(make_catcher(spec), spec.get('priority', 100)) for (spec) in specs]
+  pairs.extend([(load_class(path), 100) for (path) in classes])
+  queue.add_many(pairs)
+  return queue, [ob for (ob, priority) in pairs]
+
+class Stats(object):
+  """ throughput counters for the CLI """
+  def __init__(self):
+    self.lines_in = self.lines_out = self.chars_in = 0
+    self.start = time.time()
+    return
+
+  def merge(self, other):
+    self.lines_in += other.lines_in
+    self.lines_out += other.lines_out
+    self.chars_in += other.chars_in
+    return
+
+  def __str__(self):
+    secs = max(time.time() - self.start, 1e-9)
+    return "%d lines in, %d lines out, %d chars in %.2fs (%.0f lines/s, %.2f Mchars/s)" % (
+      self.lines_in, self.lines_out, self.chars_in, secs,
+      self.lines_in / secs, self.chars_in / secs / 1e6)
+
+def read_ahead(infile, batch_size, depth):
+  """ yield batches of lines from infile, read (and decompressed) by a
+      thread that stays up to depth batches ahead of the consumer.  The
+      codecs release the GIL so decompression overlaps with matching.
+      When the generator is closed or the consumer fails the thread is
+      stopped and joined, so infile can be closed after. """
+  batches = Queue.Queue(depth)
+  stop = threading.Event()
+  def put(item):
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+  def reader():
+    try:
+      while True:
+        lines = infile.readlines(batch_size)
+        if not put(lines) or not lines:
+          break
+    except Exception as e:
+      put(e)
+  thread = threading.Thread(target=reader)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      lines = batches.get()
+      if isinstance(lines, Exception):
+        raise lines
+      if not lines:
+        break
+      yield lines
+  finally:
+    stop.set()
+    try:
+      while True: # unblock a put() in progress
+        batches.get_nowait()
+    except Queue.Empty:
+      pass
+    thread.join()
+  return
+
+def process(queue, infile, outfile, batch_size=1 << 20, stats=None, readahead=0):
+  """ run all of infile through queue and write what survives to outfile,
+      reading and writing batch_size characters at a time.  If readahead
+      is set infile is read by a separate thread, see read_ahead() """
+  if stats is None:
+    stats = Stats()
+  if readahead:
+    batches = read_ahead(infile, batch_size, readahead)
+  else:
+    batches = iter(lambda: infile.readlines(batch_size), [])
+  try:
+    for (lines) in batches:
+      out = [text for (text) in queue.line_many(lines) if text]
+      outfile.write(''.join(out))
+      stats.lines_in += len(lines)
+      stats.lines_out += len(out)
+      stats.chars_in += sum(map(len, lines))
+  finally:
+    if readahead:
+      batches.close() # stop the reader thread
+  return stats
+
+# magic number -> opener for compressed input
+compressed_openers = [
+  (b'\x1f\x8b', gzip.GzipFile),
+  (b'BZh', bz2.BZ2File),
+]
+if lzma is not None:
+  compressed_openers.append((b'\xfd7zXZ\x00', lzma.LZMAFile))
+
+def open_input(path, buffer_size):
+  """ open path for reading text, gzip/bz2/xz files are decompressed """
+  with io.open(path, 'rb') as f:
+    magic = f.read(6)
+  for (prefix, opener) in compressed_openers:
+    if magic.startswith(prefix):
+      raw = io.BufferedReader(opener(path, 'rb'), buffer_size)
+      return io.TextIOWrapper(raw, encoding='utf-8', errors='surrogateescape', newline='')
+  return io.open(path, 'r', buffering=buffer_size, encoding='utf-8',
+                 errors='surrogateescape', newline='')
+
+def open_output(path, buffer_size):
+  if path is None:
+    sys.stdout.flush()
+    return io.open(sys.stdout.fileno(), 'w', buffering=buffer_size, encoding='utf-8',
+                   errors='surrogateescape', newline='', closefd=False)
+  return io.open(path, 'w', buffering=buffer_size, encoding='utf-8',
+                 errors='surrogateescape', newline='')
+
+def _process_file(args):
+  """ --jobs worker, process one file into a temp file """
+  path, specs, classes, compiled, buffer_size, readahead, tmpdir = args
+  queue, catchers = make_queue(specs, classes, compiled)
+  fd, outpath = tempfile.mkstemp(dir=tmpdir)
+  os.close(fd)
+  with open_input(path, buffer_size) as infile:
+    with open_output(outpath, buffer_size) as outfile:
+      stats = process(queue, infile, outfile, buffer_size, readahead=readahead)
+  queue.done()
+  return outpath, stats
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m textcatcher',
+    description='run catchers over files (or stdin) and print what they let through')
+  parser.add_argument('files', nargs='*', help='input files, default stdin')
+  parser.add_argument('-c', '--config', action='append', default=[],
+                      help='catcher config file, see load_specs()')
+  parser.add_argument('-C', '--catcher', action='append', default=[],
+                      help='module:Class[:action] catcher to add')
+  parser.add_argument('--compile', action='store_true',
+                      help='compile the config catchers into one generated function')
+  parser.add_argument('-o', '--output', help='output file, default stdout')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='process this many input files in parallel')
+  parser.add_argument('-b', '--buffer-size', type=int, default=1 << 20,
+                      help='read/write buffer size in bytes')
+  parser.add_argument('-r', '--readahead', type=int, default=4,
+                      help='batches to read (and decompress) ahead in a separate '
+                           'thread, 0 to read inline')
+  parser.add_argument('-q', '--quiet', action='store_true',
+                      help="don't report throughput on stderr")
+  opts = parser.parse_args(argv)
+
+  specs = []
+  for (path) in opts.config:
+    with io.open(path, encoding='utf-8') as f:
+      specs.extend(load_specs(f))
+  stats = Stats()
+  outfile = open_output(opts.output, opts.buffer_size)
+  try:
+    if opts.jobs > 1 and len(opts.files) > 1:
+      tmpdir = tempfile.mkdtemp()
+      pool = multiprocessing.Pool(opts.jobs)
+      try:
+        jobs = [(path, specs, opts.catcher, opts.compile, opts.buffer_size,
+                 opts.readahead, tmpdir) for (path) in opts.files]
+        for (outpath, file_stats) in pool.imap(_process_file, jobs):
+          with io.open(outpath, 'r', encoding='utf-8', errors='surrogateescape',
+                       newline='') as f:
+            shutil.copyfileobj(f, outfile, opts.buffer_size)
+          os.unlink(outpath)
+          stats.merge(file_stats)
+      finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir)
+    else:
+      # a fresh queue per file, like the --jobs workers, so counts don't
+      # carry from one file to the next
+      if not opts.files:
+        queue, catchers = make_queue(specs, opts.catcher, opts.compile)
+        stdin = io.open(sys.stdin.fileno(), 'r', buffering=opts.buffer_size, encoding='utf-8',
+                        errors='surrogateescape', newline='', closefd=False)
+        process(queue, stdin, outfile, opts.buffer_size, stats, opts.readahead)
+        queue.done()
+      for (path) in opts.files:
+        queue, catchers = make_queue(specs, opts.catcher, opts.compile)
+        with open_input(path, opts.buffer_size) as infile:
+          process(queue, infile, outfile, opts.buffer_size, stats, opts.readahead)
+        queue.done()
+  finally:
+    outfile.close()
+  if not opts.quiet:
+    sys.stderr.write("%s\n" % (stats,))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())